@@ -4,6 +4,9 @@ import re
 import shutil
 import random
 import math
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
 
 
 def read_csv(csv_file):
@@ -202,6 +205,359 @@ def validate_image_organization(output_dir, lesion_to_diagnostic, diagnosis_to_d
     return total_images, correct_images, incorrect_images, error_images
 
 
+# Perceptual-hash duplicate detection
+
+HASH_SIZE = 8  # 8x8 DCT coefficients -> 64-bit hash
+DCT_SIZE = 32  # Images are downscaled to 32x32 grayscale before the DCT
+
+# Orthonormal DCT-II basis, so the hash only needs numpy
+_DCT_MATRIX = np.sqrt(2 / DCT_SIZE) * np.cos(
+    np.pi * (2 * np.arange(DCT_SIZE)[None, :] + 1) * np.arange(DCT_SIZE)[:, None] / (2 * DCT_SIZE))
+_DCT_MATRIX[0] /= np.sqrt(2)
+
+# Number of set bits for every byte value, used to popcount packed hashes
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def compute_perceptual_hash(image_path):
+    """
+    Compute the 64-bit DCT perceptual hash (pHash) of an image.
+
+    Args:
+        image_path (str): Path to the image
+
+    Returns:
+        int: The hash packed into a 64-bit integer
+    """
+    with Image.open(image_path) as img:
+        # Let the JPEG decoder downscale while decoding instead of decoding full size
+        img.draft('L', (DCT_SIZE * 2, DCT_SIZE * 2))
+        pixels = np.asarray(img.convert('L').resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR),
+                            dtype=np.float64)
+
+    dct = _DCT_MATRIX @ pixels @ _DCT_MATRIX.T
+    low_freq = dct[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = low_freq > np.median(low_freq[1:])
+
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distances(hash_value, hashes):
+    """
+    Hamming distance between one hash and an array of hashes.
+
+    Args:
+        hash_value (np.uint64): Reference hash
+        hashes (np.ndarray): Array of uint64 hashes
+
+    Returns:
+        np.ndarray: Number of differing bits for each hash
+    """
+    xor = np.bitwise_xor(hashes, np.uint64(hash_value))
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def list_split_images(split_dirs):
+    """
+    List every image under a set of split directories.
+
+    Args:
+        split_dirs (dict): Mapping from split name to a directory or list of directories.
+            Directories listed under the same split (e.g. {'train': ['data/train',
+            'data/balanced_train']}) are never reported as leaking into each other.
+
+    Returns:
+        pd.DataFrame: One row per image with columns path, split and diagnosis
+    """
+    rows = []
+    for split_name, dirs in split_dirs.items():
+        if isinstance(dirs, str):
+            dirs = [dirs]
+
+        for split_dir in dirs:
+            if not os.path.isdir(split_dir):
+                print(f"Warning: Split directory {split_dir} does not exist")
+                continue
+
+            for root, _, files in os.walk(split_dir):
+                for image_file in files:
+                    if image_file.lower().endswith(('.png', '.jpg', '.jpeg')):
+                        rows.append({
+                            "path": os.path.join(root, image_file),
+                            "split": split_name,
+                            "diagnosis": os.path.basename(root)
+                        })
+
+    return pd.DataFrame(rows, columns=["path", "split", "diagnosis"])
+
+
+def compute_image_hashes(image_paths, cache_file=None, workers=None):
+    """
+    Compute perceptual hashes in parallel, reusing cached hashes of unchanged files.
+
+    Args:
+        image_paths (list): Paths of the images to hash
+        cache_file (str): CSV file where hashes are cached by path, size and modification time;
+            it can be shared between calls over different directories. Unreadable files are
+            cached too and skipped until they change
+        workers (int): Number of worker processes (default: number of CPUs)
+
+    Returns:
+        np.ndarray: uint64 hashes aligned with image_paths (0 for unreadable images)
+        np.ndarray: Boolean mask of images that could be hashed
+    """
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        # An empty phash marks a file that could not be read
+        cache_df = pd.read_csv(cache_file, dtype={"phash": str}, keep_default_na=False)
+        cache = {row.path: (row.size, row.mtime_ns, row.phash) for row in cache_df.itertuples(index=False)}
+
+    hashes = np.zeros(len(image_paths), dtype=np.uint64)
+    valid = np.zeros(len(image_paths), dtype=bool)
+    file_stats = []
+    pending = []
+    unreadable_count = 0
+
+    for i, path in enumerate(image_paths):
+        stat = os.stat(path)
+        file_stats.append((stat.st_size, stat.st_mtime_ns))
+        cached = cache.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            if cached[2]:
+                hashes[i] = np.uint64(int(cached[2], 16))
+                valid[i] = True
+            else:
+                unreadable_count += 1
+        else:
+            pending.append(i)
+
+    print(f"Hashing {len(pending)} images ({len(image_paths) - len(pending) - unreadable_count} cached, "
+          f"{unreadable_count} skipped as unreadable until they change)...")
+
+    if pending:
+        pending_paths = [image_paths[i] for i in pending]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_safe_perceptual_hash, pending_paths, chunksize=64)
+            for count, (i, hash_value) in enumerate(zip(pending, results), start=1):
+                if hash_value is not None:
+                    hashes[i] = np.uint64(hash_value)
+                    valid[i] = True
+                if count % 1000 == 0:
+                    print(f"Hashed {count}/{len(pending)} images")
+
+    if cache_file:
+        # Merge into the existing cache so other directories sharing it keep their
+        # entries; only files that no longer exist are dropped
+        requested = set(image_paths)
+        cache = {path: entry for path, entry in cache.items()
+                 if path in requested or os.path.exists(path)}
+        for i in pending:
+            size, mtime = file_stats[i]
+            cache[image_paths[i]] = (size, mtime, f"{int(hashes[i]):016x}" if valid[i] else "")
+
+        pd.DataFrame(
+            [(path, size, mtime, phash) for path, (size, mtime, phash) in cache.items()],
+            columns=["path", "size", "mtime_ns", "phash"]
+        ).to_csv(cache_file, index=False)
+        print(f"Hash cache saved to {cache_file}")
+
+    return hashes, valid
+
+
+def _safe_perceptual_hash(image_path):
+    """Hash an image in a worker process, returning None if it cannot be read"""
+    try:
+        return compute_perceptual_hash(image_path)
+    except Exception as e:
+        print(f"Error hashing {image_path}: {str(e)}")
+        return None
+
+
+def find_near_duplicate_pairs(hashes, max_distance=6):
+    """
+    Find all pairs of hashes within max_distance bits of each other.
+
+    Uses multi-index hashing: the 64 bits are cut into max_distance + 1 bands, and two
+    hashes within max_distance bits must match exactly on at least one band. Only
+    hashes sharing a band bucket are compared, which keeps the search near-linear.
+    Pass unique hashes: exact duplicates would otherwise fill the buckets with
+    all-pairs comparisons.
+
+    Args:
+        hashes (np.ndarray): Array of unique uint64 hashes
+        max_distance (int): Maximum Hamming distance to consider a near-duplicate (0-63)
+
+    Returns:
+        dict: Mapping from (i, j) index pairs (i < j) to their Hamming distance
+    """
+    if not 0 <= max_distance < 64:
+        raise ValueError(f"max_distance must be between 0 and 63 bits, got {max_distance}.")
+
+    num_bands = max_distance + 1
+    band_edges = np.linspace(0, 64, num_bands + 1).astype(int)
+    pairs = {}
+
+    for band_start, band_end in zip(band_edges[:-1], band_edges[1:]):
+        mask = np.uint64((1 << int(band_end - band_start)) - 1)
+        band_values = (hashes >> np.uint64(band_start)) & mask
+
+        # Group indices by band value; buckets with one member have no candidates
+        order = np.argsort(band_values, kind='stable')
+        bucket_starts = np.flatnonzero(np.diff(band_values[order])) + 1
+        for bucket in np.split(order, bucket_starts):
+            if len(bucket) < 2:
+                continue
+            bucket = np.sort(bucket)
+            bucket_hashes = hashes[bucket]
+            for k in range(len(bucket) - 1):
+                distances = hamming_distances(bucket_hashes[k], bucket_hashes[k + 1:])
+                for offset in np.flatnonzero(distances <= max_distance):
+                    pairs[(int(bucket[k]), int(bucket[k + 1 + offset]))] = int(distances[offset])
+
+    return pairs
+
+
+def cluster_duplicate_pairs(hash_counts, pairs):
+    """
+    Group near-duplicate hashes into clusters (connected components).
+
+    Args:
+        hash_counts (np.ndarray): Number of images sharing each unique hash
+        pairs (dict): Mapping from (i, j) hash index pairs to Hamming distance
+
+    Returns:
+        list: Clusters as sorted lists of hash indices, largest (in images) first.
+            A hash shared by several images is a cluster even without near-duplicates.
+    """
+    parent = list(range(len(hash_counts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    clusters = {}
+    members = {index for pair in pairs for index in pair}
+    members.update(int(i) for i in np.flatnonzero(hash_counts > 1))
+    for i in members:
+        clusters.setdefault(find(i), []).append(i)
+
+    return sorted((sorted(cluster) for cluster in clusters.values()),
+                  key=lambda cluster: hash_counts[cluster].sum(), reverse=True)
+
+
+def create_duplicate_report(images, num_pairs, report_dir, max_distance=6):
+    """
+    Save the duplicate clusters and the cross-split leak report.
+
+    Leaks are reported per image (one row for every image in a cluster that spans
+    more than one split), so a large cluster adds rows linearly, not quadratically.
+
+    Args:
+        images (pd.DataFrame): Images with columns path, split, diagnosis, phash and
+            cluster (-1 for images without duplicates)
+        num_pairs (int): Number of near-duplicate hash pairs found
+        report_dir (str): Directory where to save the reports
+        max_distance (int): Hamming threshold used to build the clusters
+
+    Returns:
+        pd.DataFrame: Images belonging to clusters that span several splits
+    """
+    print("\nCreating duplicate report...")
+    os.makedirs(report_dir, exist_ok=True)
+
+    clustered = images[images['cluster'] >= 0].sort_values(['cluster', 'split', 'path'])
+    by_cluster = clustered.groupby('cluster')
+    clustered = clustered.assign(
+        cluster_size=by_cluster['path'].transform('size'),
+        cluster_splits=by_cluster['split'].transform(lambda splits: '+'.join(sorted(set(splits)))),
+        label_conflict=by_cluster['diagnosis'].transform('nunique') > 1
+    )
+    clusters_path = os.path.join(report_dir, "duplicate_clusters.csv")
+    clustered.to_csv(clusters_path, index=False)
+
+    leaks = clustered[by_cluster['split'].transform('nunique') > 1]
+    leaks_path = os.path.join(report_dir, "split_leaks.csv")
+    leaks.to_csv(leaks_path, index=False)
+    leak_clusters = leaks.drop_duplicates('cluster')
+
+    # Generate report string
+    report = "Duplicate Image Report\n"
+    report += "======================\n\n"
+    report += f"Images hashed: {len(images)} ({images['phash'].nunique()} distinct hashes), "
+    report += f"Hamming threshold: {max_distance}/64 bits\n"
+    report += f"Near-duplicate hash pairs: {num_pairs}\n"
+    report += f"Duplicate clusters: {clustered['cluster'].nunique()} ({len(clustered)} images)\n"
+    report += f"Clusters leaking across splits: {len(leak_clusters)} ({len(leaks)} images)\n"
+    report += f"Leaking clusters with conflicting diagnosis: {int(leak_clusters['label_conflict'].sum())}\n\n"
+
+    if len(leaks):
+        leak_counts = leak_clusters.groupby('cluster_splits').agg(
+            clusters=('cluster', 'size'), images=('cluster_size', 'sum')).reset_index()
+        report += leak_counts.to_string(header=['Splits', 'Clusters', 'Images'], index=False)
+        report += "\n"
+
+    report_path = os.path.join(report_dir, "duplicate_report.txt")
+    with open(report_path, 'w') as f:
+        f.write(report)
+
+    print(f"Duplicate clusters saved to {clusters_path}")
+    print(f"Split leaks saved to {leaks_path}")
+    print(f"Report saved to {report_path}")
+    print(report)
+    return leaks
+
+
+def find_duplicate_images(split_dirs, report_dir, cache_file=None, max_distance=6, workers=None):
+    """
+    Detect duplicate and near-duplicate images across dataset splits.
+
+    Args:
+        split_dirs (dict): Mapping from split name to a directory or list of directories
+        report_dir (str): Directory where to save the reports
+        cache_file (str): CSV file used to cache the hashes between runs
+        max_distance (int): Maximum Hamming distance (0-63 bits) for near-duplicates
+        workers (int): Number of worker processes used for hashing
+
+    Returns:
+        list: Duplicate clusters as lists of image paths
+        pd.DataFrame: Images belonging to clusters that span several splits
+    """
+    # Fail before hashing the whole corpus rather than in the search
+    if not 0 <= max_distance < 64:
+        raise ValueError(f"max_distance must be between 0 and 63 bits, got {max_distance}.")
+
+    print("\nDetecting duplicate images...")
+    images = list_split_images(split_dirs)
+
+    hashes, valid = compute_image_hashes(images['path'].tolist(), cache_file, workers)
+    images = images[valid].reset_index(drop=True)
+    hashes = hashes[valid]
+    images['phash'] = [f"{int(h):016x}" for h in hashes]
+
+    # Search over distinct hashes only, then expand back to images
+    unique_hashes, hash_index, hash_counts = np.unique(hashes, return_inverse=True, return_counts=True)
+    pairs = find_near_duplicate_pairs(unique_hashes, max_distance)
+    clusters = cluster_duplicate_pairs(hash_counts, pairs)
+    print(f"Found {len(pairs)} near-duplicate hash pairs in {len(clusters)} clusters")
+
+    hash_cluster = np.full(len(unique_hashes), -1)
+    for cluster_id, members in enumerate(clusters):
+        hash_cluster[members] = cluster_id
+    images['cluster'] = hash_cluster[hash_index]
+
+    leaks = create_duplicate_report(images, len(pairs), report_dir, max_distance)
+
+    cluster_paths = images[images['cluster'] >= 0].groupby('cluster')['path'].apply(sorted)
+    return cluster_paths.sort_index().tolist(), leaks
+
+
 def create_train_val_test_directories(source_dir, train_dir, val_dir, test_dir):
     """
     Create directory structure for train, validation, and test sets.
@@ -460,6 +816,8 @@ def main():
     train_dir = 'data/train'
     val_dir = 'data/validation'
     test_dir = 'data/test'
+    balanced_train_dir = 'data/balanced_train'  # Written by data_augmentation.ipynb
+    ham_split_dir = 'data/HAM10000_split'  # Used by cnn_dermai.ipynb
 
     # Step 1: Organize the dataset by diagnosis
     organize_dataset(csv_file, image_dir, organized_dir)
@@ -467,6 +825,17 @@ def main():
     # Step 2: Create train/val/test splits
     create_train_val_test_split(organized_dir, train_dir, val_dir, test_dir)
 
+    # Step 3: Check for duplicate images leaking across splits
+    # Augmented copies belong to the training side, so balanced_train is scanned as 'train'
+    find_duplicate_images({'train': [train_dir, balanced_train_dir], 'validation': val_dir, 'test': test_dir},
+                          'data', cache_file='data/phash_cache.csv')
+
+    # Same check for the split the training notebook reads from
+    if os.path.isdir(ham_split_dir):
+        find_duplicate_images({split: os.path.join(ham_split_dir, split)
+                               for split in ['train', 'validation', 'test']},
+                              ham_split_dir, cache_file='data/phash_cache.csv')
+
 
 if __name__ == "__main__":
     main()